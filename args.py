@@ -2,6 +2,7 @@ import argparse
 import sys
 import yaml
 import os
+import zipfile
 import torch
 
 from configs import parser as _parser
@@ -38,6 +39,12 @@ def parse_arguments():
         metavar="N",
         help="number of data loading workers (default: 20)",
     )
+    parser.add_argument(
+        "--prefetch-factor",
+        default=4,
+        type=int,
+        help="Number of batches each data loading worker loads in advance",
+    )
     parser.add_argument(
         "--epochs",
         default=90,
@@ -133,6 +140,15 @@ def parse_arguments():
     parser.add_argument(
         "--seed", default=None, type=int, help="seed for initializing training. "
     )
+    parser.add_argument(
+        "--strict_reproducibility",
+        "--deterministic",
+        dest="strict_reproducibility",
+        action="store_true",
+        default=False,
+        help="Bit-reproducible runs for a given seed: use deterministic cuDNN kernels "
+        "(disables cuDNN benchmark autotuning and TF32 matmuls/convolutions)",
+    )
     parser.add_argument(
         "--multigpu",
         default=None,
@@ -151,6 +167,18 @@ def parse_arguments():
         type=int,
         help='node rank for distributed training'
     )
+    parser.add_argument(
+        "--amp",
+        action="store_true",
+        default=False,
+        help="Train with automatic mixed precision (float16 autocast and gradient scaling)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Compile the model with torch.compile before training",
+    )
     parser.add_argument(
         "--histograms",
         dest="histograms",
@@ -180,6 +208,12 @@ def parse_arguments():
     parser.add_argument(
         "--save_every", default=-1, type=int, help="Save every ___ epochs"
     )
+    parser.add_argument(
+        "--save_initial",
+        action="store_true",
+        default=False,
+        help="Save the model and optimizer state before training to initial.state",
+    )
     parser.add_argument(
         "--prune-rate",
         default=0.0,
@@ -239,6 +273,11 @@ def parse_arguments():
         action="store_true",
         help="Whether or not to print weight distributions for debugging purposes",
     )
+    parser.add_argument(
+        "--detect_anomaly",
+        action="store_true",
+        help="Enable autograd anomaly detection (slow, for debugging NaNs)",
+    )
     parser.add_argument(
         "--grad-clip",
         action="store_true",
@@ -330,9 +369,12 @@ def parse_arguments():
     if args.pretrained:
       if os.path.isfile(args.pretrained):
         print("=> checking conv_type of pretrained model from '{}'".format(args.pretrained))
+        # Legacy (pre zip format) checkpoints can't be memory-mapped
         pretrained_dict = torch.load(
             args.pretrained,
-            map_location=torch.device("cuda:{}".format(args.multigpu[0])),
+            map_location="cpu",
+            mmap=zipfile.is_zipfile(args.pretrained),
+            weights_only=True,
         )
         try:
           # Set conv_type argument to conv_type of pretrained model
@@ -3,6 +3,7 @@ import pathlib
 import random
 import time
 import pickle
+import zipfile
 
 from torch.utils.tensorboard import SummaryWriter
 import torch
@@ -15,17 +16,21 @@ import torch.utils.data.distributed
 
 from utils.conv_type import FixedSubnetConv, SampleSubnetConv
 from utils.logging import AverageMeter, ProgressMeter
+from utils.prefetch import CUDAPrefetcher
 from utils.net_utils import (
     set_model_prune_rate,
     bn_weight_init,
     freeze_model_weights,
     save_checkpoint,
+    wait_for_checkpoints,
+    unwrap_model,
+    strip_module_prefix,
     get_params,
-    get_lr,
     LabelSmoothing,
 )
 from utils.schedulers import get_policy
 from utils.conv_type import GetGlobalSubnet
+from trainers.default import global_prune_threshold
 
 
 from args import args
@@ -37,17 +42,31 @@ import models
 
 def main():
     print(args)
-    torch.autograd.set_detect_anomaly(True)
+    # Anomaly detection checks every autograd op, only enable it for debugging
+    if args.detect_anomaly:
+        torch.autograd.set_detect_anomaly(True)
     if args.seed is not None:
         random.seed(args.seed)
         torch.manual_seed(args.seed)
         torch.cuda.manual_seed(args.seed)
         torch.cuda.manual_seed_all(args.seed)
-# Set to make training deterministic for seed
-        torch.backends.cudnn.benchmark = False
-        torch.backends.cudnn.deterministic = True
 
-    args.distributed = False
+    # Seeding alone only fixes initialization and data order. Only force
+    # deterministic kernels when explicitly requested, otherwise let cuDNN
+    # autotune conv algorithms and use TF32 tensor cores on Ampere and newer
+    if args.strict_reproducibility:
+        cudnn.benchmark = False
+        cudnn.deterministic = True
+        torch.backends.cuda.matmul.allow_tf32 = False
+        cudnn.allow_tf32 = False
+    else:
+        cudnn.benchmark = True
+        cudnn.deterministic = False
+        torch.backends.cuda.matmul.allow_tf32 = True
+        cudnn.allow_tf32 = True
+
+    # torch.distributed.run exports WORLD_SIZE and LOCAL_RANK for each process
+    args.distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
 
     # Simply call main_worker function
     main_worker(args)
@@ -55,6 +74,7 @@ def main():
 
 def main_worker(args):
     args.gpu = None
+    args.rank = 0
     train, validate, modifier = get_trainer(args)
 
     if args.gpu is not None:
@@ -63,42 +83,14 @@ def main_worker(args):
     # create model and optimizer
     model = get_model(args)
     model = set_gpu(args, model)
+    model = compile_model(args, model)
     #print(list(model.parameters()))
     if args.pretrained:
         pretrained(args, model)
 
-        # Assuming args.pretrained points to your .pt file
-    pretrained_path = "resnet18_fine_tuned_CIFAR10.pt"
-    print("This is a test ******************************************************************88")
-    # Load the pre-trained model weights
-    if os.path.isfile(pretrained_path):
-        print(f"=> loading pretrained model from '{pretrained_path}'")
-        #pretrained_dict = torch.load(pretrained_path)
-        pretrained_model = torch.load(pretrained_path)
-
-        # Extract the state_dict from the loaded model
-        pretrained_dict = pretrained_model.state_dict()
-
-        # Assuming the .pt file contains only the state_dict
-        #if 'state_dict' in pretrained_dict:
-        #    pretrained_dict = pretrained_dict['state_dict']
-
-        model_dict = model.state_dict()
-
-        # Filter out unnecessary keys
-        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-
-        # Overwrite entries in the existing state dict
-        model_dict.update(pretrained_dict)
-
-        # Load the new state dict into the model
-        model.load_state_dict(model_dict)
-
-        print("=> loaded pretrained model")
-    else:
-        print(f"=> no pretrained model found at '{pretrained_path}'")
-
     optimizer = get_optimizer(args, model)
+    # A disabled scaler is a pass-through, so trainers always step through it
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
     data, train_augmentation = get_dataset(args)
     lr_policy = get_policy(args.lr_policy)(optimizer, args)
 
@@ -116,7 +108,7 @@ def main_worker(args):
     best_train_acc5 = 0.0
 
     if args.resume:
-        best_acc1 = resume(args, model, optimizer)
+        best_acc1 = resume(args, model, optimizer, scaler)
         print("ARGS.RESUME")
 
     # Data loading code
@@ -128,13 +120,21 @@ def main_worker(args):
 
         return
 
+    if args.compile:
+        warmup_model(args, model, data.train_loader)
+
     # Set up directories
-    run_base_dir, ckpt_base_dir, log_base_dir = get_directories(args)
-    args.ckpt_base_dir = ckpt_base_dir
+    # Only the main process (global rank 0) writes logs and checkpoints
+    if args.rank == 0:
+        run_base_dir, ckpt_base_dir, log_base_dir = get_directories(args)
+        args.ckpt_base_dir = ckpt_base_dir
 
-    print("RUN DIR: ", run_base_dir)
+        print("RUN DIR: ", run_base_dir)
+
+        writer = SummaryWriter(log_dir=log_base_dir)
+    else:
+        writer = None
 
-    writer = SummaryWriter(log_dir=log_base_dir)
     epoch_time = AverageMeter("epoch_time", ":.4f", write_avg=False)
     validation_time = AverageMeter("validation_time", ":.4f", write_avg=False)
     train_time = AverageMeter("train_time", ":.4f", write_avg=False)
@@ -146,65 +146,88 @@ def main_worker(args):
     args.start_epoch = args.start_epoch or 0
     acc1 = None
 
+    # Settings stored with every checkpoint that don't change during the run
+    run_info = {
+        "conv_type": args.conv_type,
+        "train_augmentation": train_augmentation,
+        "use_augmix": args.augmix,
+        "jsd": args.jsd,
+        "augmix_mixture_width": args.mixture_width,
+        "augmix_mixture_depth": args.mixture_depth,
+        "augmix_severity": args.aug_severity,
+        "use_gaussian_aug": args.gaussian_aug,
+        "p_clean": args.p_clean,
+        "std_gauss": args.std_gauss,
+    }
+
     # Save the initial state
-    save_checkpoint(
-        {
-            "epoch": 0,
-            "arch": args.arch,
-            "state_dict": model.state_dict(),
-            "best_acc1": best_acc1,
-            "best_acc5": best_acc5,
-            "best_train_acc1": best_train_acc1,
-            "best_train_acc5": best_train_acc5,
-            "optimizer": optimizer.state_dict(),
-            "curr_acc1": acc1 if acc1 else "Not evaluated",
-            "conv_type": args.conv_type,
-            "prune_rate": args.prune_rate,
-            "train_augmentation": train_augmentation,
-            "use_augmix": args.augmix,
-            "jsd": args.jsd,
-            "augmix_mixture_width": args.mixture_width,
-            "augmix_mixture_depth": args.mixture_depth,
-            "augmix_severity": args.aug_severity,
-            "use_gaussian_aug": args.gaussian_aug,
-            "p_clean": args.p_clean,
-            "std_gauss": args.std_gauss,
-        },
-        False,
-        filename=ckpt_base_dir / f"initial.state",
-        save=False,
-    )
+    if args.save_initial and args.rank == 0:
+        save_checkpoint(
+            {
+                "epoch": 0,
+                "arch": args.arch,
+                "state_dict": unwrap_model(model).state_dict(),
+                "best_acc1": best_acc1,
+                "best_acc5": best_acc5,
+                "best_train_acc1": best_train_acc1,
+                "best_train_acc5": best_train_acc5,
+                "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
+                "curr_acc1": acc1 if acc1 else "Not evaluated",
+                "prune_rate": args.prune_rate,
+                **run_info,
+            },
+            False,
+            filename=ckpt_base_dir / f"initial.state",
+            save=False,
+        )
 
     # Set final_prune_rate for gradually increasing pruning rate in global pruning
     final_prune_rate = args.prune_rate
 
+    is_global = args.conv_type == "GlobalSubnetConv"
+    is_sample = args.conv_type == "SampleSubnetConv"
+    if is_sample:
+        # The set of sampled layers doesn't change during training
+        sample_modules = [
+            (n, m) for n, m in model.named_modules() if isinstance(m, SampleSubnetConv)
+        ]
+
     # Start training
     # torch.cuda.empty_cache()
     for epoch in range(args.start_epoch, args.epochs):
+        # Reshuffle the distributed shards differently every epoch
+        if args.distributed:
+            data.train_sampler.set_epoch(epoch)
 
         # If using global pruning, gradually increase pruning rate to avoid layer collapse
-        if args.conv_type == "GlobalSubnetConv" and epoch < args.prune_rate_epoch:
+        if is_global and epoch < args.prune_rate_epoch:
           if args.prune_rate <= 0.5:
              prune_decay = (1 - (epoch/args.prune_rate_epoch))**3
              curr_prune_rate = (1-final_prune_rate) + ((0.5 - (1-final_prune_rate))*prune_decay)
              args.prune_rate = (1-curr_prune_rate)
-             print("args.prune_rate = ", args.prune_rate)
-        elif args.conv_type == "GlobalSubnetConv" and epoch == args.prune_rate_epoch:
+             if args.rank == 0:
+                 print("args.prune_rate = ", args.prune_rate)
+        elif is_global and epoch == args.prune_rate_epoch:
           args.prune_rate = final_prune_rate
-          print("args.prune_rate = ", args.prune_rate)
+          if args.rank == 0:
+              print("args.prune_rate = ", args.prune_rate)
 
 
         lr_policy(epoch, iteration=None)
         modifier(args, epoch, model)
 
-        cur_lr = get_lr(optimizer)
+        cur_lr = optimizer.param_groups[0]["lr"]
         # torch.nn.utils.clip_grad_value_(model.parameters(),2)
 
         # train for one epoch
+        # Wait for queued gpu work so it isn't counted in the timings
+        torch.cuda.synchronize()
         start_train = time.time()
         train_acc1, train_acc5 = train(
-            data.train_loader, model, criterion, optimizer, epoch, args, writer=writer
+            data.train_loader, model, criterion, optimizer, epoch, args, writer=writer, scaler=scaler
         )
+        torch.cuda.synchronize()
         train_time.update((time.time() - start_train) / 60)
 
         # evaluate on validation set
@@ -212,6 +235,10 @@ def main_worker(args):
         acc1, acc5 = validate(data.val_loader, model, criterion, args, writer, epoch)
         validation_time.update((time.time() - start_validation) / 60)
 
+        # trainers return python floats, so the comparisons below don't sync the gpu
+        train_acc1, train_acc5 = float(train_acc1), float(train_acc5)
+        acc1, acc5 = float(acc1), float(acc5)
+
         # remember best acc@1 and save checkpoint
         is_best = acc1 > best_acc1
         best_acc1 = max(acc1, best_acc1)
@@ -223,7 +250,7 @@ def main_worker(args):
            raise SystemExit("Terminating early: Network is not learning") 
 
         save = ((epoch % args.save_every) == 0) and args.save_every > 0
-        if is_best or save or epoch == args.epochs - 1:
+        if args.rank == 0 and (is_best or save or epoch == args.epochs - 1):
             if is_best:
                 print(f"==> New best {best_acc1}, saving at {ckpt_base_dir / 'model_best.pth'}")
 
@@ -231,87 +258,52 @@ def main_worker(args):
                 {
                     "epoch": epoch + 1,
                     "arch": args.arch,
-                    "state_dict": model.state_dict(),
+                    "state_dict": unwrap_model(model).state_dict(),
                     "best_acc1": best_acc1,
                     "best_acc5": best_acc5,
                     "best_train_acc1": best_train_acc1,
                     "best_train_acc5": best_train_acc5,
                     "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
                     "curr_acc1": acc1,
                     "curr_acc5": acc5,
-                    "conv_type": args.conv_type,
                     "prune_rate": args.prune_rate,
-                    "train_augmentation": train_augmentation,
-                    "use_augmix": args.augmix,
-                    "jsd": args.jsd,
-                    "augmix_mixture_width": args.mixture_width,
-                    "augmix_mixture_depth": args.mixture_depth,
-                    "augmix_severity": args.aug_severity,
-                    "use_gaussian_aug": args.gaussian_aug,
-                    "p_clean": args.p_clean,
-                    "std_gauss": args.std_gauss,
+                    **run_info,
                 },
                 is_best,
                 filename=ckpt_base_dir / f"epoch_most_recent.state",
                 save=save,
-            )
-
-            save_checkpoint(
-                {
-                    "epoch": epoch + 1,
-                    "arch": args.arch,
-                    "state_dict": model.state_dict(),
-                    "best_acc1": best_acc1,
-                    "best_acc5": best_acc5,
-                    "best_train_acc1": best_train_acc1,
-                    "best_train_acc5": best_train_acc5,
-                    "optimizer": optimizer.state_dict(),
-                    "curr_acc1": acc1,
-                    "curr_acc5": acc5,
-                    "conv_type": args.conv_type,
-                    "prune_rate": args.prune_rate,
-                    "train_augmentation": train_augmentation,
-                    "use_augmix": args.augmix,
-                    "jsd": args.jsd,
-                    "augmix_mixture_width": args.mixture_width,
-                    "augmix_mixture_depth": args.mixture_depth,
-                    "augmix_severity": args.aug_severity,
-                    "use_gaussian_aug": args.gaussian_aug,
-                    "p_clean": args.p_clean,
-                    "std_gauss": args.std_gauss,
-                },
-                is_best,
-                filename=ckpt_base_dir / f"epoch_{epoch}.state",
-                save=save,
+                copies=[ckpt_base_dir / f"epoch_{epoch}.state"],
             )
             #filename=ckpt_base_dir / f"epoch_{epoch}.state",
 
+        torch.cuda.synchronize()
         epoch_time.update((time.time() - end_epoch) / 60)
+
+        if args.rank != 0:
+            end_epoch = time.time()
+            continue
+
         progress_overall.display(epoch)
         progress_overall.write_to_tensorboard(
             writer, prefix="diagnostics", global_step=epoch
         )
 
-        if args.conv_type == "SampleSubnetConv":
-            count = 0
-            sum_pr = 0.0
-            for n, m in model.named_modules():
-                if isinstance(m, SampleSubnetConv):
-                    # avg pr across 10 samples
-                    pr = 0.0
-                    for _ in range(10):
-                        pr += (
-                            (torch.rand_like(m.clamped_scores) >= m.clamped_scores)
-                            .float()
-                            .mean()
-                            .item()
-                        )
-                    pr /= 10.0
-                    writer.add_scalar("pr/{}".format(n), pr, epoch)
-                    sum_pr += pr
-                    count += 1
-
-            args.prune_rate = sum_pr / count
+        if is_sample:
+            prs = []
+            with torch.no_grad():
+                for n, m in sample_modules:
+                    # avg pr across 10 samples, drawn in a single batch
+                    # (a weight is pruned with probability 1 - score)
+                    p_pruned = 1 - m.clamped_scores
+                    prs.append(torch.bernoulli(p_pruned.expand(10, *p_pruned.shape)).mean())
+
+            # Copy all layer prune rates to the host at once
+            prs = torch.stack(prs).cpu().tolist()
+            for (n, _), pr in zip(sample_modules, prs):
+                writer.add_scalar("pr/{}".format(n), pr, epoch)
+
+            args.prune_rate = sum(prs) / len(prs)
             writer.add_scalar("pr/average", args.prune_rate, epoch)
 
         writer.add_scalar("test/lr", cur_lr, epoch)
@@ -319,8 +311,14 @@ def main_worker(args):
         #print("EPOCH TIME: ", end_epoch-start_train)
         #torch.cuda.empty_cache()
 
+    if args.rank != 0:
+        return
+
+    # Make sure the background checkpoint writes have finished
+    wait_for_checkpoints()
+
     # Finalize prune rate for globally pruned networks
-    if args.conv_type == "GlobalSubnetConv":
+    if is_global:
       global_pr, prune_dict = global_prune_rate(model, args)
       # Save prune rate dictionary to file in checkpoint directory
       dict_filename=f"{ckpt_base_dir}/global_prune_rate_dictionary.pkl"
@@ -353,6 +351,10 @@ def main_worker(args):
 
 
 def get_trainer(args):
+    if args.distributed and args.trainer == "lottery":
+        # The lottery modifier flips requires_grad after the model is wrapped in DDP
+        raise ValueError("The lottery trainer does not support distributed training")
+
     print(f"=> Using trainer from trainers.{args.trainer}")
     trainer = importlib.import_module(f"trainers.{args.trainer}")
 
@@ -362,40 +364,99 @@ def get_trainer(args):
 def set_gpu(args, model):
     assert torch.cuda.is_available(), "CPU-only experiments currently unsupported"
 
-    if args.gpu is not None:
+    if args.distributed:
+        # One process per gpu, launched with torch.distributed.run
+        torch.distributed.init_process_group(backend="nccl", init_method="env://")
+        args.world_size = torch.distributed.get_world_size()
+        args.rank = torch.distributed.get_rank()
+        args.gpu = int(os.environ["LOCAL_RANK"])
+        print(f"=> Distributed training: rank {args.rank}/{args.world_size} on gpu {args.gpu}")
+
+        # Batch size and workers are given for the whole job, split them across processes
+        args.batch_size = int(args.batch_size / args.world_size)
+        args.workers = int((args.workers + args.world_size - 1) / args.world_size)
+
         torch.cuda.set_device(args.gpu)
         model = model.cuda(args.gpu)
-    elif args.multigpu is None:
-        device = torch.device("cpu")
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
     else:
-        # DataParallel will divide and allocate batch_size to all available GPUs
-        print(f"=> Parallelizing on {args.multigpu} gpus")
-        torch.cuda.set_device(args.multigpu[0])
-        args.gpu = args.multigpu[0]
-        model = torch.nn.DataParallel(model, device_ids=args.multigpu).cuda(
-            args.multigpu[0]
-        )
-    if args.seed is None:
-        cudnn.benchmark = True
+        if args.gpu is None:
+            args.gpu = args.multigpu[0] if args.multigpu is not None else 0
+        if args.multigpu is not None and len(args.multigpu) > 1:
+            print(
+                f"=> Single process run uses gpu {args.gpu} only, launch with "
+                "torch.distributed.run to train on multiple gpus"
+            )
+        torch.cuda.set_device(args.gpu)
+        model = model.cuda(args.gpu)
 
     return model
 
 
-def resume(args, model, optimizer):
+def compile_model(args, model):
+    if args.compile:
+        print("=> Compiling model with torch.compile")
+        # Compile in place so state_dict keys (checkpoints, pretrained, resume) are unchanged.
+        # The subnet convs use custom autograd functions, so allow graph breaks and avoid max-autotune
+        model.compile(mode="reduce-overhead", fullgraph=False)
+
+    return model
+
+
+def warmup_model(args, model, train_loader):
+    # One forward/backward pass on a real batch so the first training epoch
+    # does not pay for compilation. Buffers (BatchNorm running stats) and RNG
+    # states are restored afterwards so training starts from the same state
+    print("=> Warming up compiled model")
+    rng_state = random.getstate()
+    torch_rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state_all()
+    buffers = [(b, b.clone()) for b in model.buffers()]
+
+    images, _ = next(iter(train_loader))
+    if args.jsd:
+        images = torch.cat(images, 0)
+    images = images.cuda(args.gpu, non_blocking=True)
+
+    # GlobalSubnetConv layers only get a prune threshold inside the training loop
+    if args.conv_type == "GlobalSubnetConv":
+        global_prune_threshold(model, args)
+
+    model.train()
+    # Trace under the same autocast setting as training so it isn't recompiled
+    with torch.cuda.amp.autocast(enabled=args.amp):
+        loss = model(images).float().sum()
+    loss.backward()
+    model.zero_grad()
+
+    with torch.no_grad():
+        for b, saved in buffers:
+            b.copy_(saved)
+    random.setstate(rng_state)
+    torch.set_rng_state(torch_rng_state)
+    torch.cuda.set_rng_state_all(cuda_rng_state)
+
+
+def resume(args, model, optimizer, scaler):
     if os.path.isfile(args.resume):
         print(f"=> Loading checkpoint '{args.resume}'")
 
-        checkpoint = torch.load(args.resume, map_location=f"cuda:{args.multigpu[0]}")
+        checkpoint = torch.load(args.resume, map_location=f"cuda:{args.gpu}")
         if args.start_epoch is None:
             print(f"=> Setting new start epoch at {checkpoint['epoch']}")
             args.start_epoch = checkpoint["epoch"]
 
-        best_acc1 = checkpoint["best_acc1"]
+        # Older checkpoints may hold best_acc1 as a (gpu) tensor
+        best_acc1 = float(checkpoint["best_acc1"])
 
-        model.load_state_dict(checkpoint["state_dict"])
+        unwrap_model(model).load_state_dict(strip_module_prefix(checkpoint["state_dict"]))
 
         optimizer.load_state_dict(checkpoint["optimizer"])
 
+        # Checkpoints written without --amp (or before it existed) have no scaler state
+        if checkpoint.get("scaler"):
+            scaler.load_state_dict(checkpoint["scaler"])
+
         print(f"=> Loaded checkpoint '{args.resume}' (epoch {checkpoint['epoch']})")
 
         return best_acc1
@@ -406,22 +467,27 @@ def resume(args, model, optimizer):
 def pretrained(args, model):
     if os.path.isfile(args.pretrained):
         print("=> loading pretrained weights from '{}'".format(args.pretrained))
+        # Memory-map the tensors instead of reading the whole file up front,
+        # legacy (pre zip format) checkpoints can only be read eagerly
         pretrained = torch.load(
             args.pretrained,
-            map_location=torch.device("cuda:{}".format(args.multigpu[0])),
+            map_location="cpu",
+            mmap=zipfile.is_zipfile(args.pretrained),
+            weights_only=True,
         )["state_dict"]
+        pretrained = strip_module_prefix(pretrained)
 
-        model_state_dict = model.state_dict()
+        # Only the shapes of the model's entries are needed for filtering
+        model_shapes = {k: v.shape for k, v in unwrap_model(model).state_dict().items()}
         for k, v in pretrained.items():
-            if k not in model_state_dict or v.size() != model_state_dict[k].size():
+            if k not in model_shapes or v.shape != model_shapes[k]:
                 print("IGNORE:", k)
         pretrained = {
             k: v
             for k, v in pretrained.items()
-            if (k in model_state_dict and v.size() == model_state_dict[k].size())
+            if (k in model_shapes and v.shape == model_shapes[k])
         }
-        model_state_dict.update(pretrained)
-        model.load_state_dict(model_state_dict)
+        unwrap_model(model).load_state_dict(pretrained, strict=False)
 
     else:
         print("=> no pretrained weights found at '{}'".format(args.pretrained))
@@ -448,9 +514,48 @@ def get_dataset(args):
     print(f"=> Getting {args.set} dataset")
     dataset = getattr(data, args.set)(args)
 
+    # Keep workers alive across epochs and let them load ahead of the training loop
+    dataset.train_loader = tune_loader(args, dataset.train_loader)
+    dataset.val_loader = tune_loader(args, dataset.val_loader)
+    if args.distributed:
+        dataset.train_sampler = dataset.train_loader.sampler
+
+    # Overlap the host to device copy of the next training batch with the current step
+    dataset.train_loader = CUDAPrefetcher(
+        dataset.train_loader, torch.device("cuda", args.gpu)
+    )
+
     return dataset, train_augmentation
 
 
+def tune_loader(args, loader):
+    sampler = loader.sampler
+    # Not every dataset shards itself across processes, do it here for the ones that don't
+    if args.distributed and not isinstance(
+        sampler, torch.utils.data.distributed.DistributedSampler
+    ):
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            loader.dataset,
+            shuffle=isinstance(sampler, torch.utils.data.RandomSampler),
+        )
+    elif loader.num_workers == 0:
+        return loader
+
+    # Reuse the dataset's sampler so shuffling and distributed sharding are unchanged
+    return torch.utils.data.DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=sampler,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        worker_init_fn=loader.worker_init_fn,
+        persistent_workers=loader.num_workers > 0,
+        prefetch_factor=args.prefetch_factor if loader.num_workers > 0 else None,
+    )
+
+
 def get_model(args):
     if args.first_layer_dense:
         args.first_layer_type = "DenseConv"
@@ -539,9 +644,10 @@ def get_directories(args):
         run_base_dir = run_base_dir / "width_mult={}".format(str(args.width_mult))
 
     if _run_dir_exists(run_base_dir):
-        rep_count = 0
-        while _run_dir_exists(run_base_dir / str(rep_count)):
-            rep_count += 1
+        # List the repeat directories once instead of stat-ing each one in turn
+        with os.scandir(run_base_dir) as entries:
+            reps = [int(e.name) for e in entries if e.name.isdigit() and e.is_dir()]
+        rep_count = max(reps, default=-1) + 1
 
         run_base_dir = run_base_dir / str(rep_count)
 
@@ -610,50 +716,46 @@ def write_result_to_csv(**kwargs):
         )
 
 # Compute global prune rate at end of training
+@torch.no_grad()
 def global_prune_rate(model, args):
     # Initialize dictionary to store prune rates for each layer
     prune_dict = {}
     # Print breakdown of prune rate by layer
     print("\n==> Final layerwise prune rates in network:")
-    # Loop over all model parameters and compute percentage of weights pruned globally
-    total_weights = 0
-    unpruned_weights = 0
+    # Collect layer names, sizes and (on device) unpruned counts, then sync once
+    names = []
+    layer_totals = []
+    layer_unpruned = []
     # Loop over all model parameters to get sparsity of each layer
     for n, m in model.named_modules():
       # Only add parameters that have prune_threshold as attribute
       if hasattr(m,'prune_threshold'):
-        tmp_scores = m.clamped_scores.clone().detach()
-        # Add to total_weights
-        layer_total = int(torch.numel(tmp_scores))
-        #print("Total number of weights in layer = ", t)
-        total_weights += layer_total
-        # Compute layer prune rate (doesn't seem to be stored correctly during multigpu runs)
-        w = GetGlobalSubnet.apply(tmp_scores, m.weight.detach().clone(), m.prune_threshold)
-        # Compute number of unpruned weights in layer
-        layer_unpruned = torch.count_nonzero(w).item()
+        # Compute layer mask (doesn't seem to be stored correctly during multigpu runs)
+        w = GetGlobalSubnet.apply(m.clamped_scores, m.weight, m.prune_threshold)
+        names.append(n)
+        layer_totals.append(w.numel())
+        # Number of unpruned weights in layer, left on device
+        layer_unpruned.append(torch.count_nonzero(w))
+
+    # Single device to host copy for all layers
+    layer_unpruned = torch.stack(layer_unpruned).tolist()
+
+    for n, layer_total, unpruned in zip(names, layer_totals, layer_unpruned):
         # Compute pruning rate for current layer
-        layer_prune_rate = 1 - (layer_unpruned/layer_total)
-        # Compute number of pruned weights
+        layer_prune_rate = 1 - (unpruned/layer_total)
         print("%s prune percentage: %lg" %(n,100*layer_prune_rate))
-        unpruned_weights += layer_unpruned
         # Add prune_rate for current layer to dictionary
         prune_dict[n] = 100*layer_prune_rate
-        # Set prune threshold value (same for all layers)
-        pr_thresh = m.prune_threshold
 
     # Compute global pruning percentage
-    #print ("total_weights = ", total_weights)
-    #print ("pruned_weights = ", unpruned_weights)
+    total_weights = sum(layer_totals)
+    unpruned_weights = sum(layer_unpruned)
     final_prune_rate = (1 - (unpruned_weights/total_weights))
-    #print("Global pruning percentage: ", 100 * final_prune_rate)
     print("\n==> Global prune rate: ", 1-final_prune_rate)
 
-    #print("\n==> Final prune threshold value: ", pr_thresh)
-
     # Return global prune rate
     return (1-final_prune_rate), prune_dict
 
 
-
 if __name__ == "__main__":
     main()
@@ -18,6 +18,8 @@ from utils.net_utils import (
     set_model_prune_rate,
     freeze_model_weights,
     save_checkpoint,
+    unwrap_model,
+    strip_module_prefix,
     get_lr,
     LabelSmoothing,
 )
@@ -94,6 +96,7 @@ def main_worker(args):
         pretrained(args, model)
 
     optimizer = get_optimizer(args, model)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
     data = get_dataset(args)
     lr_policy = get_policy(args.lr_policy)(optimizer, args)
 
@@ -111,7 +114,7 @@ def main_worker(args):
     best_train_acc5 = 0.0
 
     if args.resume:
-        best_acc1 = resume(args, model, optimizer)
+        best_acc1 = resume(args, model, optimizer, scaler)
 
     # Data loading code
     if args.evaluate:
@@ -154,12 +157,13 @@ def main_worker(args):
             {
                 "epoch": 0,
                 "arch": args.arch,
-                "state_dict": model.state_dict(),
+                "state_dict": unwrap_model(model).state_dict(),
                 "best_acc1": best_acc1,
                 "best_acc5": best_acc5,
                 "best_train_acc1": best_train_acc1,
                 "best_train_acc5": best_train_acc5,
                 "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
                 "curr_acc1": acc1 if acc1 else "Not evaluated",
             },
             False,
@@ -182,7 +186,7 @@ def main_worker(args):
         # train for one epoch
         start_train = time.time()
         train_acc1, train_acc5 = train(
-            data.train_loader, model, criterion, optimizer, epoch, args, writer=writer
+            data.train_loader, model, criterion, optimizer, epoch, args, writer=writer, scaler=scaler
         )
         #train_acc1, train_acc5 = train(
         #    data.train_loader, model, criterion, optimizer, epoch, args, writer=None
@@ -219,12 +223,13 @@ def main_worker(args):
                     {
                         "epoch": epoch + 1,
                         "arch": args.arch,
-                        "state_dict": model.state_dict(),
+                        "state_dict": unwrap_model(model).state_dict(),
                         "best_acc1": best_acc1,
                         "best_acc5": best_acc5,
                         "best_train_acc1": best_train_acc1,
                         "best_train_acc5": best_train_acc5,
                         "optimizer": optimizer.state_dict(),
+                        "scaler": scaler.state_dict(),
                         "curr_acc1": acc1,
                         "curr_acc5": acc5,
                     },
@@ -331,7 +336,7 @@ def lassen_set_gpu(args, model):
     return model
 
 
-def resume(args, model, optimizer):
+def resume(args, model, optimizer, scaler):
     if os.path.isfile(args.resume):
         print(f"=> Loading checkpoint '{args.resume}'")
 
@@ -347,10 +352,14 @@ def resume(args, model, optimizer):
         ## NEW: best_acc1 may be from a checkpoint from a different GPU
         #best_acc1 = best_acc1.to(args.gpu)
 
-        model.load_state_dict(checkpoint["state_dict"])
+        unwrap_model(model).load_state_dict(strip_module_prefix(checkpoint["state_dict"]))
 
         optimizer.load_state_dict(checkpoint["optimizer"])
 
+        # Checkpoints written without --amp (or before it existed) have no scaler state
+        if checkpoint.get("scaler"):
+            scaler.load_state_dict(checkpoint["scaler"])
+
         print(f"=> Loaded checkpoint '{args.resume}' (epoch {checkpoint['epoch']})")
 
         return best_acc1
@@ -365,8 +374,9 @@ def pretrained(args, model):
             args.pretrained,
             map_location=torch.device("cuda:{}".format(args.multigpu[0])),
         )["state_dict"]
+        pretrained = strip_module_prefix(pretrained)
 
-        model_state_dict = model.state_dict()
+        model_state_dict = unwrap_model(model).state_dict()
         for k, v in pretrained.items():
             if k not in model_state_dict or v.size() != model_state_dict[k].size():
                 print("IGNORE:", k)
@@ -376,7 +386,7 @@ def pretrained(args, model):
             if (k in model_state_dict and v.size() == model_state_dict[k].size())
         }
         model_state_dict.update(pretrained)
-        model.load_state_dict(model_state_dict)
+        unwrap_model(model).load_state_dict(model_state_dict)
 
     else:
         print("=> no pretrained weights found at '{}'".format(args.pretrained))
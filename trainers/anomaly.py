@@ -2,14 +2,14 @@ import time
 import torch
 import tqdm
 
-from utils.eval_utils import accuracy
+from utils.eval_utils import accuracy, all_reduce_meters
 from utils.logging import AverageMeter, ProgressMeter
 
 
 __all__ = ["train", "validate", "modifier"]
 
 
-def train(train_loader, model, criterion, optimizer, epoch, args, writer):
+def train(train_loader, model, criterion, optimizer, epoch, args, writer, scaler):
     batch_time = AverageMeter("Time", ":6.3f")
     data_time = AverageMeter("Data", ":6.3f")
     losses = AverageMeter("Loss", ":.3f")
@@ -47,9 +47,10 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
             #      writer.add_histogram(param_name, model.state_dict()[param_name], epoch)
 
             # compute output
-            output = model(images)
+            with torch.cuda.amp.autocast(enabled=args.amp):
+                output = model(images)
 
-            loss = criterion(output, target)
+                loss = criterion(output, target)
 
             # measure accuracy and record loss
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -59,8 +60,9 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
 
             # compute gradient and do SGD step
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             # Clamp updated scores to [-1,1] only when using binarized/quantized activations
             #for param_name in model.state_dict():
@@ -100,11 +102,12 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
             #  #  writer.add_histogram('Layer' + str(j) + 'grad', params[j].grad, epoch)
 
     # Write final scores and weights to tensorboard
-    for param_name in model.state_dict():
-      #writer.add_histogram(param_name, model.state_dict()[param_name], epoch)
-      # Only write scores for now (not weights and batch norm parameters since the pytorch parms don't actually change)
-      if 'score' in param_name:
-        writer.add_histogram(param_name, model.state_dict()[param_name], epoch)
+    if writer is not None:
+      for param_name in model.state_dict():
+        #writer.add_histogram(param_name, model.state_dict()[param_name], epoch)
+        # Only write scores for now (not weights and batch norm parameters since the pytorch parms don't actually change)
+        if 'score' in param_name:
+          writer.add_histogram(param_name, model.state_dict()[param_name], epoch)
 
     return top1.avg, top5.avg
 
@@ -146,10 +149,14 @@ def validate(val_loader, model, criterion, args, writer, epoch):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % args.print_freq == 0:
+            if i % args.print_freq == 0 and args.rank == 0:
                 progress.display(i)
 
-        progress.display(len(val_loader))
+        # Each process only sees its shard of the validation set, combine them
+        all_reduce_meters((losses, top1, top5), args)
+
+        if args.rank == 0:
+            progress.display(len(val_loader))
 
         if writer is not None:
             progress.write_to_tensorboard(writer, prefix="test", global_step=epoch)
@@ -3,7 +3,7 @@ import torch
 import tqdm
 import torch.nn.functional as F
 
-from utils.eval_utils import accuracy
+from utils.eval_utils import accuracy, all_reduce_meters
 from utils.logging import AverageMeter, ProgressMeter
 
 __all__ = ["train", "validate", "modifier"]
@@ -42,7 +42,7 @@ def global_prune_threshold(model, args):
     # Exit function
     return
 
-def train(train_loader, model, criterion, optimizer, epoch, args, writer):
+def train(train_loader, model, criterion, optimizer, epoch, args, writer, scaler):
     batch_time = AverageMeter("Time", ":6.3f")
     data_time = AverageMeter("Data", ":6.3f")
     losses = AverageMeter("Loss", ":.3f")
@@ -75,7 +75,7 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
           target = target.cuda(args.gpu, non_blocking=True)
 
         # Write scores and weights to tensorboard at beginning of every other epoch
-        if args.histograms:
+        if args.histograms and writer is not None:
           if (i % (num_batches * batch_size) == 0) and (epoch % 2 == 0):
             for param_name in model.state_dict():
               #print(param_name)
@@ -92,9 +92,10 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
 
         # compute loss without Jensen-Shannon divergence
         if args.jsd == False:
-          output = model(images)
+          with torch.cuda.amp.autocast(enabled=args.amp):
+            output = model(images)
 
-          loss = criterion(output, target)
+            loss = criterion(output, target)
 
           # measure accuracy and record loss
           acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -103,19 +104,20 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
           top5.update(acc5.item(), images.size(0))
 
         else: # compute loss with Jensen-Shannon divergence
-          logits_all = model(images_all)
-          logits_clean, logits_aug1, logits_aug2 = torch.split(logits_all, images[0].size(0))
-          output = logits_clean # This is just used for accuracy function
+          with torch.cuda.amp.autocast(enabled=args.amp):
+            logits_all = model(images_all)
+            logits_clean, logits_aug1, logits_aug2 = torch.split(logits_all, images[0].size(0))
+            output = logits_clean # This is just used for accuracy function
 
-          # Cross-entropy is only computed on clean images
-          loss = criterion(logits_clean, target)
+            # Cross-entropy is only computed on clean images
+            loss = criterion(logits_clean, target)
 
-          # Terms for Jensen-Shannon divergence
-          p_clean, p_aug1, p_aug2 = F.softmax(logits_clean, dim=1), F.softmax(logits_aug1, dim=1), F.softmax(logits_aug2, dim=1)
+            # Terms for Jensen-Shannon divergence
+            p_clean, p_aug1, p_aug2 = F.softmax(logits_clean, dim=1), F.softmax(logits_aug1, dim=1), F.softmax(logits_aug2, dim=1)
 
-          # Clamp mixture distribution to avoid exploding KL divergence
-          p_mixture = torch.clamp((p_clean + p_aug1 + p_aug2) / 3., 1e-7, 1).log()
-          loss += 12 * (F.kl_div(p_mixture, p_clean, reduction='batchmean') + F.kl_div(p_mixture, p_aug1, reduction='batchmean') + F.kl_div(p_mixture, p_aug2, reduction='batchmean')) / 3.
+            # Clamp mixture distribution to avoid exploding KL divergence
+            p_mixture = torch.clamp((p_clean + p_aug1 + p_aug2) / 3., 1e-7, 1).log()
+            loss += 12 * (F.kl_div(p_mixture, p_clean, reduction='batchmean') + F.kl_div(p_mixture, p_aug1, reduction='batchmean') + F.kl_div(p_mixture, p_aug2, reduction='batchmean')) / 3.
 
           # measure accuracy and record loss
           acc1, acc5 = accuracy(logits_clean, target, topk=(1, 5))
@@ -126,15 +128,19 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
         # compute gradient and do SGD step
         optimizer.zero_grad()
         #torch.nn.utils.clip_grad_norm_(model.parameters(),1)
-        loss.backward()
+        scaler.scale(loss).backward()
         # EDITED
         #print(torch.norm(torch.cat([p.grad.view(-1) for p in model.parameters()])))
-        if args.grad_clip: torch.nn.utils.clip_grad_value_(model.parameters(),1) 
+        if args.grad_clip:
+          # Clip the true gradients, not the loss-scaled ones
+          scaler.unscale_(optimizer)
+          torch.nn.utils.clip_grad_value_(model.parameters(),1)
         #print(torch.norm(torch.cat([p.grad.view(-1) for p in model.parameters()])))
         #for param_name in model.state_dict(): print(param_name, str(model.state_dict()[param_name])[:50])
         #torch.nn.utils.clip_grad_norm_(model.parameters(),1)
         # end
-        optimizer.step()
+        scaler.step(optimizer)
+        scaler.update()
 
         # Clamp updated scores to [-1,1] only when using binarized/quantized activations
         #for param_name in model.state_dict():
@@ -152,7 +158,7 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
         #params = list(model.parameters())
         #print(params[1].grad)
 
-        if i % args.print_freq == 0:
+        if i % args.print_freq == 0 and args.rank == 0:
             t = (num_batches * epoch + i) * batch_size
             progress.display(i)
 
@@ -160,7 +166,7 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
             progress.write_to_tensorboard(writer, prefix="train", global_step=t)
 
         # Write score gradients to tensorboard at end of every other epoch
-        if args.histograms:
+        if args.histograms and writer is not None:
             if (i % (num_batches * batch_size) == 0) and (epoch % 2 == 0):
             #if ((i+1) % (num_batches-1) == 0) and (epoch % 2 == 0):
               params = list(model.parameters())
@@ -182,7 +188,7 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
               #  writer.add_histogram('Layer' + str(j) + 'grad', params[j].grad, epoch)
 
     # Write final scores and weights to tensorboard
-    if args.histograms:
+    if args.histograms and writer is not None:
         for param_name in model.state_dict():
           #writer.add_histogram(param_name, model.state_dict()[param_name], epoch)
           # Only write scores for now (not weights and batch norm parameters since the pytorch parms don't actually change)
@@ -235,12 +241,16 @@ def validate(val_loader, model, criterion, args, writer, epoch):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % args.print_freq == 0:
+            if i % args.print_freq == 0 and args.rank == 0:
                 progress.display(i)
                 #_, predicted = torch.max(output, 1)
                 #print(predicted,target)
 
-        progress.display(len(val_loader))
+        # Each process only sees its shard of the validation set, combine them
+        all_reduce_meters((losses, top1, top5), args)
+
+        if args.rank == 0:
+            progress.display(len(val_loader))
 
         if writer is not None:
             progress.write_to_tensorboard(writer, prefix="test", global_step=epoch)
@@ -2,7 +2,7 @@ import time
 import torch
 import tqdm
 
-from utils.eval_utils import accuracy
+from utils.eval_utils import accuracy, all_reduce_meters
 from utils.logging import AverageMeter, ProgressMeter
 from utils.net_utils import (
     freeze_model_subnet,
@@ -10,14 +10,15 @@ from utils.net_utils import (
     set_model_prune_rate,
     unfreeze_model_weights,
     unfreeze_model_subnet,
-    save_checkpoint
+    save_checkpoint,
+    unwrap_model,
 )
 
 
 __all__ = ["train", "validate", "modifier"]
 
 
-def train(train_loader, model, criterion, optimizer, epoch, args, writer):
+def train(train_loader, model, criterion, optimizer, epoch, args, writer, scaler):
     batch_time = AverageMeter("Time", ":6.3f")
     data_time = AverageMeter("Data", ":6.3f")
     losses = AverageMeter("Loss", ":.3f")
@@ -47,9 +48,10 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
         target = target.cuda(args.gpu, non_blocking=True)
 
         # compute output
-        output = model(images)
+        with torch.cuda.amp.autocast(enabled=args.amp):
+            output = model(images)
 
-        loss = criterion(output, target)
+            loss = criterion(output, target)
 
         # measure accuracy and record loss
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -59,14 +61,16 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if i % args.print_freq == 0:
+        # Only the main process (global rank 0) has a tensorboard writer
+        if i % args.print_freq == 0 and args.rank == 0:
             t = (num_batches * epoch + i) * batch_size
             progress.display(i)
             progress.write_to_tensorboard(writer, prefix="train", global_step=t)
@@ -111,10 +115,14 @@ def validate(val_loader, model, criterion, args, writer, epoch):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % args.print_freq == 0:
+            if i % args.print_freq == 0 and args.rank == 0:
                 progress.display(i)
 
-        progress.display(len(val_loader))
+        # Each process only sees its shard of the validation set, combine them
+        all_reduce_meters((losses, top1, top5), args)
+
+        if args.rank == 0:
+            progress.display(len(val_loader))
 
         if writer is not None:
             progress.write_to_tensorboard(writer, prefix="test", global_step=epoch)
@@ -133,11 +141,14 @@ def modifier(args, epoch, model):
         unfreeze_model_subnet(model)
         freeze_model_weights(model)
 
+        if args.rank != 0:
+            return
+
         save_checkpoint(
             {
                 "epoch": epoch,
                 "arch": args.arch,
-                "state_dict": model.state_dict(),
+                "state_dict": unwrap_model(model).state_dict(),
                 "best_acc1": 0.0,
                 "best_acc5": 0.0,
                 "best_train_acc1": 0.0,
@@ -2,14 +2,14 @@ import time
 import torch
 import tqdm
 
-from utils.eval_utils import accuracy
+from utils.eval_utils import accuracy, all_reduce_meters
 from utils.logging import AverageMeter, ProgressMeter
 
 
 __all__ = ["train", "validate", "modifier"]
 
 
-def train(train_loader, model, criterion, optimizer, epoch, args, writer):
+def train(train_loader, model, criterion, optimizer, epoch, args, writer, scaler):
     batch_time = AverageMeter("Time", ":6.3f")
     data_time = AverageMeter("Data", ":6.3f")
     losses = AverageMeter("Loss", ":.3f")
@@ -40,9 +40,10 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
         target = target.cuda(args.gpu, non_blocking=True)
     
         # compute output
-        output = model(images)
+        with torch.cuda.amp.autocast(enabled=args.amp):
+            output = model(images)
     
-        loss = criterion(output, target)
+            loss = criterion(output, target)
     
         # measure accuracy and record loss
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -52,8 +53,9 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
     
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
     
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -64,7 +66,8 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer):
             if i % args.print_freq == 0:
                 t = (num_batches * epoch + i) * batch_size
                 progress.display(i)
-                progress.write_to_tensorboard(writer, prefix="train", global_step=t)
+                if writer is not None:
+                    progress.write_to_tensorboard(writer, prefix="train", global_step=t)
 
     return top1.avg, top5.avg
 
@@ -106,10 +109,14 @@ def validate(val_loader, model, criterion, args, writer, epoch):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % args.print_freq == 0:
+            if i % args.print_freq == 0 and args.rank == 0:
                 progress.display(i)
 
-        progress.display(len(val_loader))
+        # Each process only sees its shard of the validation set, combine them
+        all_reduce_meters((losses, top1, top5), args)
+
+        if args.rank == 0:
+            progress.display(len(val_loader))
 
         if writer is not None:
             progress.write_to_tensorboard(writer, prefix="test", global_step=epoch)
@@ -16,3 +16,16 @@ def accuracy(output, target, topk=(1,)):
             correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
             res.append(correct_k.mul_(100.0 / batch_size))
         return res
+
+
+def all_reduce_meters(meters, args):
+    """Combines AverageMeters across processes so every rank sees the global averages"""
+    if not args.distributed:
+        return
+
+    for meter in meters:
+        totals = torch.tensor([meter.sum, meter.count], device=f"cuda:{args.gpu}")
+        torch.distributed.all_reduce(totals)
+        # Single host copy per meter, so the returned averages are python floats
+        meter.sum, meter.count = totals.tolist()
+        meter.avg = meter.sum / meter.count
@@ -1,4 +1,8 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import io
+import mmap
 import os
 import pathlib
 import shutil
@@ -9,13 +13,76 @@ import torch.nn as nn
 from args import args as parser_args
 
 
-def save_checkpoint(state, is_best, filename="checkpoint.pth", save=False):
+# Checkpoints are written by a single background thread so that writes to the
+# same file land in order. Two sets of cpu staging buffers are used in turn, so
+# the next checkpoint can be staged while the previous one is still being written.
+_save_executor = ThreadPoolExecutor(max_workers=1)
+_staging_buffers = [{}, {}]
+_pending_saves = [None, None]
+_save_count = 0
+
+# O_DIRECT needs block aligned buffers, offsets and sizes
+_DIRECT_IO_ALIGN = 4096
+_DIRECT_IO_CHUNK = 64 * 1024 * 1024
+
+
+def save_checkpoint(state, is_best, filename="checkpoint.pth", save=False, copies=()):
+    global _save_count
+
     filename = pathlib.Path(filename)
 
     if not filename.parent.exists():
         os.makedirs(filename.parent)
 
-    torch.save(state, filename)
+    slot = _save_count % 2
+    _save_count += 1
+
+    # Wait for the save that last used this set of staging buffers
+    if _pending_saves[slot] is not None:
+        _pending_saves[slot].result()
+
+    # Snapshot on the training thread so later optimizer steps can't leak into the file
+    cpu_state = _copy_to_cpu(state, _staging_buffers[slot])
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    _pending_saves[slot] = _save_executor.submit(
+        _write_checkpoint, cpu_state, is_best, filename, save, copies
+    )
+
+
+def wait_for_checkpoints():
+    for future in _pending_saves:
+        if future is not None:
+            future.result()
+
+
+def _copy_to_cpu(obj, buffers, key=()):
+    if isinstance(obj, torch.Tensor):
+        buf = buffers.get(key)
+        if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+            buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            buffers[key] = buf
+        return buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+    elif isinstance(obj, dict):
+        copy = type(obj)((k, _copy_to_cpu(v, buffers, key + (k,))) for k, v in obj.items())
+        # model.state_dict() carries per-module versions used by _load_from_state_dict
+        if hasattr(obj, "_metadata"):
+            copy._metadata = obj._metadata
+        return copy
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(v, buffers, key + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+def _write_checkpoint(state, is_best, filename, save, copies):
+    # Write to a temporary file and rename, so hard links made from an older
+    # version of this file keep their contents
+    tmp_filename = filename.parent / (filename.name + ".tmp")
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    _write_direct(buffer.getbuffer(), tmp_filename)
+    os.replace(tmp_filename, filename)
 
     if is_best:
         shutil.copyfile(filename, str(filename.parent / "model_best.pth"))
@@ -24,6 +91,79 @@ def save_checkpoint(state, is_best, filename="checkpoint.pth", save=False):
             if filename.exists():
                 print("file exists")
                 os.remove(filename)
+            return
+
+    # Identical checkpoints under other names share the written file
+    for copy in copies:
+        copy = pathlib.Path(copy)
+        if copy.exists():
+            os.remove(copy)
+        try:
+            os.link(filename, copy)
+        except OSError:
+            shutil.copyfile(filename, copy)
+
+
+def _write_direct(data, filename):
+    # Write large aligned blocks with O_DIRECT, bypassing the page cache.
+    # Falls back to a buffered write where O_DIRECT isn't supported (e.g. tmpfs, macOS)
+    size = len(data)
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+    except (AttributeError, OSError):
+        with open(filename, "wb") as f:
+            f.write(data)
+        return
+
+    try:
+        # Anonymous mmaps are page aligned
+        with mmap.mmap(-1, _DIRECT_IO_CHUNK) as block:
+            offset = 0
+            while offset < size:
+                n = min(_DIRECT_IO_CHUNK, size - offset)
+                padded = -(-n // _DIRECT_IO_ALIGN) * _DIRECT_IO_ALIGN
+                block[:n] = data[offset:offset + n]
+                block[n:padded] = bytes(padded - n)
+                with memoryview(block) as view:
+                    # pwrite may write less than asked, finish the block before moving on
+                    written = 0
+                    while written < padded:
+                        count = os.pwrite(fd, view[written:padded], offset + written)
+                        if count == 0:
+                            raise OSError(f"No progress writing {filename}")
+                        written += count
+                offset += n
+        # Drop the padding of the last block
+        os.ftruncate(fd, size)
+    except OSError:
+        os.close(fd)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return
+
+    os.close(fd)
+
+
+def unwrap_model(model):
+    # Checkpoints store the bare model so they load with or without a parallel wrapper
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def strip_module_prefix(state_dict):
+    # Checkpoints saved from DataParallel/DistributedDataParallel models prefix every key with "module."
+    def strip(key):
+        if key == "module":
+            return ""
+        return key[len("module."):] if key.startswith("module.") else key
+
+    stripped = OrderedDict((strip(k), v) for k, v in state_dict.items())
+    metadata = getattr(state_dict, "_metadata", None)
+    if metadata is not None:
+        stripped._metadata = OrderedDict((strip(k), v) for k, v in metadata.items())
+
+    return stripped
 
 
 def get_lr(optimizer):
@@ -0,0 +1,66 @@
+import torch
+
+
+class CUDAPrefetcher(object):
+    """ Copies the next batch to the gpu on a side stream while the current batch is used """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.batch = None
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.reset()
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+    def reset(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.batch = self._to_device(batch)
+
+    def next(self):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.batch
+        if batch is not None:
+            # Tensors were allocated on the side stream but are consumed on the current one
+            self._record_stream(batch)
+            self.preload()
+
+        return batch
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self.device, non_blocking=True)
+        # Augmix/JSD loaders yield a list of image tensors per batch
+        return [self._to_device(b) for b in batch]
+
+    def _record_stream(self, batch):
+        if isinstance(batch, torch.Tensor):
+            batch.record_stream(torch.cuda.current_stream(self.device))
+        else:
+            for b in batch:
+                self._record_stream(b)